@@ -1,14 +1,20 @@
 import hashlib
 import hmac
 import io
+import mmap
 import os
 import pathlib
-import pickle
 import secrets
+import ssl
 import stat
 import sys
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 
 import boto3
+import msgpack
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 
@@ -18,18 +24,52 @@ class _Node:
         self.subdir = {}  # dir_str:Node
         self.file = {}  # filename: checksum
 
-    def _str_helper(self, curr: "_Node", space: int) -> str:
+    def _str_helper(self, curr: "_Node", space: int, out: list) -> None:
         spacer = space * "\t"
-        string = ""
         for sub, node in curr.subdir.items():
-            string += spacer + sub + "/\n"
-            string += self._str_helper(node, space + 1)
-        for file, checksum in curr.file.items():
-            string += spacer + file + ": " + str(checksum[:10]) + "...\n"
-        return string
+            out.append(spacer + sub + "/\n")
+            self._str_helper(node, space + 1, out)
+        for file, (checksum, _, _) in curr.file.items():
+            out.append(spacer + file + ": " + checksum.hex()[:10] + "...\n")
 
     def __str__(self) -> str:
-        return self._str_helper(self, 0)
+        parts = []
+        self._str_helper(self, 0, parts)
+        return "".join(parts)
+
+
+def _hash_fileobj_static(f, hash_func) -> bytes:
+    if hasattr(hashlib, "file_digest"):  # Python >= 3.11; optimized loop that releases the GIL
+        return hashlib.file_digest(f, hash_func).digest()
+    h = hash_func()
+    for blk in iter(lambda: f.read(1 << 20), b""):
+        h.update(blk)
+    return h.digest()
+
+
+# Module level so it can be pickled into hash worker processes;
+# hash must match AWSBackup._file_hash_func
+def _hash_file_static(path: str) -> bytes:
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size > (1 << 20):
+            # Hash straight from the page cache; skips the per-chunk copy
+            # into Python bytes objects (GIL released for large buffers)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h = hashlib.sha256()
+                h.update(mm)
+                return h.digest()
+        return _hash_fileobj_static(f, hashlib.sha256)
+
+
+# File-like writer that feeds every write to an HMAC as well as the stream
+class _HMACWriter:
+    def __init__(self, stream, mac):
+        self._stream = stream
+        self._mac = mac
+
+    def write(self, b) -> int:
+        self._mac.update(b)
+        return self._stream.write(b)
 
 
 class AWSBackup:
@@ -40,36 +80,73 @@ class AWSBackup:
         :param signature_key: Key to use when generating signatures
         """
         # Constants
-        self._p_file = "index.bin"
+        self._p_file = "index.v4.bin"  # v4: msgpack-encoded tree with raw digest bytes
         self._sig_byte_size = 64
-        self._sig_hash_func = hashlib.sha512
+        self._sig_hash_func = hashlib.sha512  # HMAC over the (small) index only
+        # Content fingerprints: SHA-256 gets hardware kernels (x86 SHA-NI, ARM CE)
+        # via OpenSSL, which SHA-512 and BLAKE2b do not
+        self._file_hash_func = hashlib.sha256
+        if "sha256" not in hashlib.algorithms_guaranteed:
+            raise AssertionError("sha256 unavailable in hashlib")
+        print("Using", ssl.OPENSSL_VERSION)
+        self._max_workers = 16
+        self._max_in_flight = 32
+        self._multipart_concurrency = 10
 
         # Variables
-        self._s3 = boto3.resource("s3")
+        # One shared client for every transfer thread; the pool must cover
+        # max_workers * multipart concurrency or bursts queue on connections
+        self._s3 = boto3.resource("s3", config=Config(
+            max_pool_connections=self._max_workers * self._multipart_concurrency,
+            retries={"max_attempts": 10, "mode": "adaptive"},
+            tcp_keepalive=True))
         self._secret_key = signature_key
-        self._bucket = None
-
-        for b in list(self._s3.buckets.all()):
-            if b.name == bucket_name:
-                self._bucket = self._s3.Bucket(bucket_name)
-        if self._bucket is None:
+        self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        self._transfer_sem = threading.BoundedSemaphore(self._max_in_flight)
+        # Larger chunks + threaded multipart; boto3 defaults do 8 KB I/O
+        self._xfer = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=16 * 1024 * 1024,
+                                    max_concurrency=self._multipart_concurrency, use_threads=True,
+                                    io_chunksize=1024 * 1024)
+
+        # Validate access with a single head_bucket instead of listing every bucket
+        try:
+            self._s3.meta.client.head_bucket(Bucket=bucket_name)
+        except ClientError:
             raise ValueError("bucket not found")
+        self._bucket = self._s3.Bucket(bucket_name)
+
+    def _hash_fileobj(self, f) -> bytes:
+        return _hash_fileobj_static(f, self._file_hash_func)
+
+    def _submit_transfer(self, func, *args) -> "Future":
+        # Bound in-flight transfers so a huge tree does not queue unbounded work
+        self._transfer_sem.acquire()
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(lambda _: self._transfer_sem.release())
+        return future
 
-    def _read_local_helper(self, full_path: str, path: str, n: _Node, follow: bool) -> None:
+    def _read_local_helper(self, full_path: str, path: str, n: _Node, follow: bool, pending: list,
+                           cache: dict, rel_path: str) -> None:
         path = os.path.normpath(path)
         curr = n.subdir[path] = _Node()
-        root, sub_dirs, files = next(os.walk(full_path))
-
-        for sub_dir in sub_dirs:
-            if not follow and os.path.islink(os.path.join(root, sub_dir)):
-                continue
-            self._read_local_helper(os.path.join(full_path, sub_dir), sub_dir, curr, follow)
-        for file in files:
-            with open(os.path.join(root, file), "rb") as f:
-                # curr.file[file] = self._sig_hash_func(f.read()).digest()
-                curr.file[file] = self._sig_hash_func(f.read()).hexdigest()
-
-    def _read_local(self, path: str, follow: bool) -> (_Node, _Node, str):
+        # scandir serves type checks from the cached DirEntry, avoiding the
+        # extra lstat per entry that os.walk + os.path.islink cost
+        with os.scandir(full_path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=follow):
+                    self._read_local_helper(entry.path, entry.name, curr, follow, pending,
+                                            cache, os.path.join(rel_path, entry.name))
+                elif entry.is_file():
+                    st = entry.stat()
+                    prev = cache.get(os.path.join(rel_path, entry.name))
+                    if prev is not None and (st.st_size, st.st_mtime_ns) == prev[1:]:
+                        # Unchanged since the previous run; reuse its digest
+                        curr.file[entry.name] = prev
+                        continue
+                    # Defer hashing so all files can be hashed as one parallel batch
+                    pending.append((curr, entry.name, entry.path, st))
+
+    def _read_local(self, path: str, follow: bool, cache: dict = None) -> (_Node, _Node, str):
         n = _Node()
         curr = n
         path = os.path.abspath(path)
@@ -79,29 +156,66 @@ class AWSBackup:
             curr.subdir[dd] = _Node()
             curr = curr.subdir[dd]
 
-        self._read_local_helper(path, dirs[-1], curr, follow)
+        pending = []
+        self._read_local_helper(path, dirs[-1], curr, follow, pending, cache if cache is not None else {}, "")
+        if pending:
+            # Hash the collected files as a batch in worker processes; unlike
+            # threads this sidesteps the GIL for the Python-side loop and I/O
+            with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+                digests = ex.map(_hash_file_static, [p for _, _, p, _ in pending], chunksize=32)
+                for (node, file, _, st), digest in zip(pending, digests):
+                    node.file[file] = (digest, st.st_size, st.st_mtime_ns)
         return n, curr.subdir[dirs[-1]], path
 
+    def _pack_tree(self, curr: _Node) -> dict:
+        # Flat typed encoding for msgpack; digests are raw bytes in memory
+        # and on the wire, so no per-file hex conversion is needed
+        return {"d": {name: self._pack_tree(node) for name, node in curr.subdir.items()},
+                "f": curr.file}
+
+    def _unpack_tree(self, obj: dict) -> _Node:
+        n = _Node()
+        for name, child in obj["d"].items():
+            n.subdir[name] = self._unpack_tree(child)
+        for name, (digest, size, mtime_ns) in obj["f"].items():
+            n.file[name] = (digest, size, mtime_ns)
+        return n
+
+    def _flatten_files(self, curr: _Node, rel_path: str, out: dict) -> dict:
+        for sub_dir_str, node in curr.subdir.items():
+            self._flatten_files(node, os.path.join(rel_path, sub_dir_str), out)
+        for file, meta in curr.file.items():
+            out[os.path.join(rel_path, file)] = meta
+        return out
+
     def _read_server(self, path: str) -> (_Node, _Node, str):
-        found = False
-        for a in self._bucket.objects.all():
-            found = a.key == self._p_file
-            if found:
-                break
+        # head_object is O(1); listing the bucket to find the index is O(N) keys
+        try:
+            self._bucket.Object(self._p_file).load()
+            found = True
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "404":
+                found = False
+            else:
+                raise
 
         if not found:
             print("No existing backup found")
             new = _Node()
         else:
             with io.BytesIO() as tmp:
-                self._bucket.Object(self._p_file).download_fileobj(tmp)
+                self._bucket.Object(self._p_file).download_fileobj(tmp, Config=self._xfer)
                 tmp.seek(0)
                 file_sig = tmp.read(self._sig_byte_size)
-                b = tmp.read()
-            sig = hmac.new(self._secret_key, b, self._sig_hash_func)
-            if not hmac.compare_digest(file_sig, sig.digest()):
-                raise AssertionError("index file signature mismatch")
-            new = pickle.loads(b)
+                # Verify and decode straight from the buffer in chunks; no
+                # second full copy of the index body as a bytes object
+                mac = hmac.new(self._secret_key, digestmod=self._sig_hash_func)
+                for chunk in iter(lambda: tmp.read(1 << 20), b""):
+                    mac.update(chunk)
+                if not hmac.compare_digest(file_sig, mac.digest()):
+                    raise AssertionError("index file signature mismatch")
+                tmp.seek(self._sig_byte_size)
+                new = self._unpack_tree(msgpack.unpack(tmp, raw=False))
 
         curr = new
         path = os.path.normpath(os.path.join("backup", path))
@@ -111,37 +225,49 @@ class AWSBackup:
 
         return new, curr, path
 
+    def _download_verify(self, local_path: str, remote_key: str, checksum: bytes) -> bool:
+        print("Downloading:", remote_key)
+        with open(local_path + ".unsafe", "w+b") as f:
+            try:
+                self._bucket.download_fileobj(remote_key, f, Config=self._xfer)
+            except ClientError as e:
+                print("Error:", e)
+                return False
+            f.seek(0)
+            print("Verification... ", end="")
+            verified = checksum == self._hash_fileobj(f)
+        if verified:
+            print("OK")
+            # Parent dirs already exist; os.replace is one atomic rename(2),
+            # unlike os.renames which walks the parent chain every call
+            os.replace(local_path + ".unsafe", local_path)
+        else:
+            print("FAIL. Removing.")
+            os.remove(local_path + ".unsafe")
+        return True
+
     def _restore_helper(self, local_full_path: str, remote_full_path: str, local_curr: _Node,
-                        remote_curr: _Node, overwrite: bool) -> int:
-        cnt = 0
-        for sub_dir_str, node in remote_curr.subdir.items():
-            local_curr.subdir.setdefault(sub_dir_str, _Node())
-            cnt += self._restore_helper(os.path.join(local_full_path, sub_dir_str),
-                                        os.path.join(remote_full_path, sub_dir_str),
-                                        local_curr.subdir[sub_dir_str], node, overwrite)
-
-        pathlib.Path(local_full_path).mkdir(parents=True, exist_ok=True)
-
-        for file, checksum in remote_curr.file.items():
-            if overwrite or file not in local_curr.file or local_curr.file[file] != checksum:
-                print("Downloading:", os.path.normpath(os.path.join(remote_full_path, file)))
-                with open(os.path.join(local_full_path, file) + ".unsafe", "w+b") as f:
-                    try:
-                        self._bucket.download_fileobj(os.path.join(remote_full_path, file), f)
-                    except ClientError as e:
-                        print("Error:", e)
-                        continue
-                    f.seek(0)
-                    print("Verification... ", end="")
-                    verified = checksum == self._sig_hash_func(f.read()).hexdigest()
-                if verified:
-                    print("OK")
-                    os.renames(os.path.join(local_full_path, file) + ".unsafe", os.path.join(local_full_path, file))
-                else:
-                    print("FAIL. Removing.")
-                    os.remove(os.path.join(local_full_path, file) + ".unsafe")
-                cnt += 1
-        return cnt
+                        remote_curr: _Node, overwrite: bool, futures: list) -> None:
+        # Iterative DFS with pre-joined paths; both inputs are already
+        # normalized, so each level needs a single concat per entry
+        sep = os.sep
+        stack = [(local_full_path, remote_full_path, local_curr, remote_curr)]
+        while stack:
+            local_dir, remote_prefix, local_node, remote_node = stack.pop()
+            for sub_dir_str, node in remote_node.subdir.items():
+                local_node.subdir.setdefault(sub_dir_str, _Node())
+                stack.append((f"{local_dir}{sep}{sub_dir_str}", f"{remote_prefix}/{sub_dir_str}",
+                              local_node.subdir[sub_dir_str], node))
+
+            pathlib.Path(local_dir).mkdir(parents=True, exist_ok=True)
+
+            local_get = local_node.file.get  # One hashed lookup per file, not two
+            for file, (checksum, _, _) in remote_node.file.items():
+                prev = local_get(file)
+                if overwrite or prev is None or prev[0] != checksum:
+                    futures.append(self._submit_transfer(self._download_verify,
+                                                         f"{local_dir}{sep}{file}", f"{remote_prefix}/{file}",
+                                                         checksum))
 
     def restore(self, local_path: str, remote_path: str, overwrite: bool = False) -> None:
         """
@@ -159,32 +285,60 @@ class AWSBackup:
 
         print("----- Remote directory tree -----\n" + str(remote_cd) + "---------------------------------")
 
-        processed = self._restore_helper(local_full_path, remote_full_path, local_cd, remote_cd, overwrite)
+        futures = []
+        self._restore_helper(local_full_path, remote_full_path, local_cd, remote_cd, overwrite, futures)
+        processed = sum(1 for future in futures if future.result())
         print("Restored %d files" % processed)
 
-    def _backup_helper(self, local_full_path: str, remote_full_path: str, local_curr: _Node, remote_curr: _Node) -> int:
-        cnt = 0
-        for sub_dir_str, node in local_curr.subdir.items():
-            # If remote does not have current sub dir, create it
-            remote_curr.subdir.setdefault(sub_dir_str, _Node())
-            cnt += self._backup_helper(os.path.join(local_full_path, sub_dir_str),
-                                       os.path.join(remote_full_path, sub_dir_str),
-                                       node, remote_curr.subdir[sub_dir_str])
-
-        for file, checksum in local_curr.file.items():
-            if file not in remote_curr.file or remote_curr.file[file] != checksum:
-                remote_curr.file[file] = checksum
-                print("Uploading: %s\t%s" % (str(file).ljust(10),
-                                             os.path.normpath(os.path.join(remote_full_path, file))))
-                self._bucket.upload_file(os.path.join(local_full_path, file),
-                                         os.path.normpath(os.path.join(remote_full_path, file)))
-                cnt += 1
-
-        # Create empty folder
-        if not local_curr.subdir and not local_curr.file:
-            self._bucket.put_object(Key=remote_full_path)
-
-        return cnt
+    def _enumerate_remote(self, prefix: str) -> dict:
+        # Ground truth of what is actually stored under the prefix, from one
+        # paginated listing; far cheaper than a head_object per candidate
+        # file, and independent of the index being present or current
+        objects = {}
+        paginator = self._s3.meta.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self._bucket.name, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                objects[obj["Key"]] = (obj["ETag"].strip('"'), obj["Size"])
+        return objects
+
+    def _upload_file(self, local_path: str, remote_key: str, remote_obj: tuple = None) -> bool:
+        # Single-part ETags are plain MD5; if the server copy already matches,
+        # skip the PUT entirely (e.g. index lost or stale after a crash)
+        if remote_obj is not None:
+            etag, size = remote_obj
+            if "-" not in etag and size == os.path.getsize(local_path):
+                with open(local_path, "rb") as f:
+                    if _hash_fileobj_static(f, hashlib.md5) == bytes.fromhex(etag):
+                        print("Skipping (same content on server):", remote_key)
+                        return False
+        print("Uploading: %s\t%s" % (os.path.basename(local_path).ljust(10), remote_key))
+        self._bucket.upload_file(local_path, remote_key, Config=self._xfer)
+        return True
+
+    def _backup_helper(self, local_full_path: str, remote_full_path: str, local_curr: _Node, remote_curr: _Node,
+                       changed: set, remote_objs: dict, futures: list) -> None:
+        # Iterative DFS with pre-joined paths; both inputs are already
+        # normalized, so each level needs a single concat per entry
+        sep = os.sep
+        stack = [(local_full_path, remote_full_path, "", local_curr, remote_curr)]
+        while stack:
+            local_dir, remote_prefix, rel_prefix, local_node, remote_node = stack.pop()
+            for sub_dir_str, node in local_node.subdir.items():
+                # If remote does not have current sub dir, create it
+                remote_node.subdir.setdefault(sub_dir_str, _Node())
+                stack.append((f"{local_dir}{sep}{sub_dir_str}", f"{remote_prefix}/{sub_dir_str}",
+                              f"{rel_prefix}{sub_dir_str}{sep}", node, remote_node.subdir[sub_dir_str]))
+
+            for file, meta in local_node.file.items():
+                remote_node.file[file] = meta
+                if f"{rel_prefix}{file}" in changed:
+                    key = f"{remote_prefix}/{file}"
+                    futures.append(self._submit_transfer(self._upload_file,
+                                                         f"{local_dir}{sep}{file}", key, remote_objs.get(key)))
+
+            # Create empty folder
+            if not local_node.subdir and not local_node.file:
+                self._bucket.put_object(Key=remote_prefix)
 
     def backup(self, local_path: str, remote_path: str, follow: bool = False) -> None:
         """
@@ -199,19 +353,36 @@ class AWSBackup:
         """
         if not os.path.isdir(local_path):
             raise ValueError("%s is not a directory" % local_path)
-        local_full_struct, local_cd, local_full_path = self._read_local(local_path, follow)
         remote_full_struct, remote_cd, remote_full_path = self._read_server(remote_path)
+        # Previous-run digests keyed by relative path; lets the local scan
+        # skip rehashing files whose size and mtime have not changed
+        cache = self._flatten_files(remote_cd, "", {})
+        local_full_struct, local_cd, local_full_path = self._read_local(local_path, follow, cache)
 
         print("----- Local directory tree -----\n" + str(local_cd) + "--------------------------------")
 
-        processed = self._backup_helper(local_full_path, remote_full_path, local_cd, remote_cd)
+        # Diff the flattened trees in one pass; the set comprehension runs at
+        # dict speed in C instead of per-node Python compares in the walk
+        local_flat = self._flatten_files(local_cd, "", {})
+        cache_get = cache.get  # One hashed lookup per file, not two
+        changed = {rel for rel, meta in local_flat.items()
+                   if (prev := cache_get(rel)) is None or prev[0] != meta[0]}
+
+        futures = []
+        remote_objs = self._enumerate_remote(remote_full_path) if changed else {}
+        self._backup_helper(local_full_path, remote_full_path, local_cd, remote_cd, changed, remote_objs, futures)
+        # Propagate upload exceptions before writing the index
+        processed = sum(1 for future in futures if future.result())
 
         with io.BytesIO() as tmp:
-            res = pickle.dumps(remote_full_struct, protocol=pickle.HIGHEST_PROTOCOL)
-            tmp.write(hmac.new(self._secret_key, res, digestmod=self._sig_hash_func).digest())
-            tmp.write(res)
+            # Sign while encoding; no second full copy of the index in RAM
+            tmp.write(bytes(self._sig_byte_size))  # Placeholder for the signature
+            mac = hmac.new(self._secret_key, digestmod=self._sig_hash_func)
+            msgpack.pack(self._pack_tree(remote_full_struct), _HMACWriter(tmp, mac), use_bin_type=True)
+            tmp.seek(0)
+            tmp.write(mac.digest())
             tmp.seek(0)
-            self._bucket.upload_fileobj(tmp, self._p_file)
+            self._bucket.upload_fileobj(tmp, self._p_file, Config=self._xfer)
 
         print("Uploaded %d files + 1 index file" % processed)
 